@@ -0,0 +1,100 @@
+"""
+Load generator for `staeon.ingress.IngressServer`. Starts the server on a
+local port, hammers /tx with keep-alive connections for a few seconds and
+reports sustained requests per second and the status codes returned.
+
+    $ python benchmarks/ingress.py --connections 50 --seconds 5
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from staeon.admission import ValidationQueue
+from staeon.ingress import IngressServer
+from staeon.transaction import make_transactions
+
+INPUTS = [
+    ['18pvhMkv1MZbZZEncKucAmVDLXZsD9Dhk6', 3.2, 'KwuVvv359oft9TfzyYLAQBgpPyCFpcTSrV9ZgJF9jKdT8jd7XLH2'],
+    ['14ZiHtrmT6Mi4RT2Liz51WKZMeyq2n5tgG', 0.5, 'KxWoW9Pj45UzUH1d5p3wPe7zxbdJqU7HHkDQF1YQS1AiQg9qeZ9H']
+]
+OUTPUTS = [
+    ['16ViwyAVeKtz4vbTXWRSYgadT5w3Rj3yuq', 2.2],
+    ['18pPTxvTc9rJZfD2tM1bNYHFhAcZjgqEdQ', 1.4]
+]
+
+def make_bodies(count, batch=0):
+    specs = [[INPUTS, [list(x) for x in OUTPUTS]] for x in range(count)]
+    txs = make_transactions(specs, workers=1)
+    if batch:
+        return [
+            urlencode({'objs': json.dumps(txs[i:i + batch])}).encode()
+            for i in range(0, len(txs), batch)
+        ]
+    return [urlencode({'obj': json.dumps(tx)}).encode() for tx in txs]
+
+async def client(port, bodies, until, statuses, batch):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    path = '/tx/batch' if batch else '/tx'
+    n = 0
+    while time.time() < until:
+        body = bodies[n % len(bodies)]
+        n += 1
+        writer.write((
+            "POST %s HTTP/1.1\r\nHost: localhost\r\n"
+            "Content-Length: %d\r\n\r\n" % (path, len(body))
+        ).encode() + body)
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b'\r\n':
+                break
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        statuses[status] = statuses.get(status, 0) + 1
+    writer.close()
+
+async def run(args):
+    queue = ValidationQueue(
+        maxsize=args.queue_size, peer_rate=args.peer_rate, peer_burst=args.peer_rate
+    )
+    server = IngressServer(tx_queue=queue, workers=args.workers)
+    port = (await server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+
+    bodies = make_bodies(args.transactions, args.batch)
+    statuses = {}
+    start = time.time()
+    until = start + args.seconds
+    await asyncio.gather(*[
+        client(port, bodies, until, statuses, args.batch)
+        for x in range(args.connections)
+    ])
+    elapsed = time.time() - start
+    await server.close()
+
+    total = sum(statuses.values())
+    print("requests:      %d in %.2fs" % (total, elapsed))
+    print("requests/sec:  %.1f" % (total / elapsed))
+    print("statuses:      %s" % json.dumps(statuses, sort_keys=True))
+    print("server stats:  %s" % json.dumps(server.stats, sort_keys=True))
+    print("queue stats:   %s" % json.dumps(queue.stats, sort_keys=True))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--transactions', type=int, default=20, help="distinct signed transactions to send, repeats are answered as duplicates")
+    parser.add_argument('--batch', type=int, default=0, help="send batches of this size to /tx/batch")
+    parser.add_argument('--queue-size', type=int, default=10000)
+    parser.add_argument('--peer-rate', type=float, default=1e9)
+    asyncio.run(run(parser.parse_args()))
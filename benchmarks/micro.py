@@ -0,0 +1,287 @@
+"""
+Microbenchmarks for the hot functions in staeon. Reports ops/sec and peak
+memory per operation, and compares against a saved JSON baseline.
+Everything runs offline, fixtures are generated locally and cached.
+
+    $ python benchmarks/micro.py --save         # record a baseline
+    $ python benchmarks/micro.py                # compare against it
+
+Exits with status 1 if any benchmark is more than `--threshold` slower (or
+uses that much more memory) than the baseline.
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from staeon import consensus, emission, transaction
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """
+    Register a benchmark. `func` takes the fixtures and returns a callable
+    that performs one operation.
+    """
+    BENCHMARKS.append(func)
+    return func
+
+def make_keys(count):
+    from bitcoin import encode_privkey, privtoaddr
+    keys = []
+    for x in range(count):
+        pk = encode_privkey(hashlib.sha256(("staeon bench %d" % x).encode()).hexdigest(), 'wif_compressed')
+        keys.append([privtoaddr(pk), pk])
+    return keys
+
+def make_fixtures(transactions=2000, peers=2000, ledger=100000, path=None):
+    """
+    Signed transactions take a while to make, so they are cached in `path`.
+    The cache is only used if it was made with the same sizes.
+    """
+    sizes = {'transactions': transactions, 'peers': peers, 'ledger': ledger}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            fixtures = json.load(f)
+        if fixtures.get('sizes') == sizes:
+            return fixtures
+
+    rand = random.Random(1)
+    keys = make_keys(50)
+    specs = []
+    for x in range(transactions):
+        inputs = [
+            [address, round(rand.uniform(1, 10), 8), pk]
+            for address, pk in rand.sample(keys, rand.randint(1, 3))
+        ]
+        total = sum(amount for address, amount, pk in inputs) - 0.01
+        outs = rand.sample(keys, rand.randint(1, 3))
+        outputs = [[address, float("%.8f" % (total / len(outs) - 0.00000001))] for address, pk in outs]
+        specs.append([inputs, outputs])
+
+    txs = transaction.make_transactions(specs)
+    fixtures = {
+        'sizes': sizes,
+        'keys': keys,
+        'specs': specs,
+        'transactions': txs,
+        'txids': [transaction.make_txid(tx) for tx in txs],
+        'peers': ["node%d.example.com" % x for x in range(peers)],
+        'ledger': sorted(
+            [["1%033d" % x, round(rand.uniform(0, 1000), 8)] for x in range(ledger)],
+            key=lambda x: (-x[1], x[0])
+        ),
+    }
+    if path:
+        with open(path, 'w') as f:
+            json.dump(fixtures, f)
+    return fixtures
+
+@benchmark
+def validate_transaction(fixtures):
+    import dateutil.parser
+    txs = itertools.cycle([
+        (tx, dateutil.parser.parse(tx['timestamp']))
+        for tx in fixtures['transactions']
+    ])
+    def op():
+        tx, ts = next(txs)
+        try:
+            transaction.validate_transaction(tx, now=ts)
+        except consensus.InvalidTimestamp:
+            pass # made during an epoch's closing interval
+    return op
+
+@benchmark
+def make_transaction(fixtures):
+    specs = itertools.cycle(fixtures['specs'])
+    def op():
+        inputs, outputs = next(specs)
+        transaction.make_transaction(inputs, list(outputs))
+    return op
+
+@benchmark
+def make_txid(fixtures):
+    txs = itertools.cycle(fixtures['transactions'])
+    return lambda: transaction.make_txid(next(txs))
+
+@benchmark
+def validate_sig(fixtures):
+    from bitcoin import ecdsa_sign
+    address, pk = fixtures['keys'][0]
+    sigs = itertools.cycle([
+        (txid, ecdsa_sign(txid, pk)) for txid in fixtures['txids'][:20]
+    ])
+    def op():
+        msg, sig = next(sigs)
+        consensus.validate_sig(sig, msg, address)
+    return op
+
+@benchmark
+def make_transaction_rejection(fixtures):
+    address, pk = fixtures['keys'][0]
+    exc = consensus.InvalidFee("bench")
+    txs = itertools.cycle([{'txid': txid} for txid in fixtures['txids']])
+    return lambda: consensus.make_transaction_rejection(next(txs), exc, 'a.com', pk)
+
+@benchmark
+def deterministic_shuffle(fixtures):
+    txids = itertools.cycle(fixtures['txids'])
+    peers = fixtures['peers']
+    return lambda: consensus.deterministic_shuffle(peers, next(txids))
+
+@benchmark
+def make_matrix(fixtures):
+    txids = itertools.cycle(fixtures['txids'])
+    peers = fixtures['peers'][:200]
+    return lambda: consensus.make_matrix(peers, next(txids))
+
+@benchmark
+def make_epoch_seed(fixtures):
+    ledger = fixtures['ledger']
+    counts = itertools.count(1000)
+    return lambda: consensus.make_epoch_seed(
+        next(counts), len(ledger), ledger, lambda x: x[0]
+    )
+
+@benchmark
+def make_mini_hashes(fixtures):
+    txids = itertools.cycle(fixtures['txids'])
+    return lambda: consensus.make_mini_hashes(next(txids), limit=25)
+
+@benchmark
+def emission_range(fixtures):
+    "emission() for 1000 epochs spread over the first 100 years."
+    epochs = itertools.cycle(range(1, 5256000, 5256))
+    def op():
+        for x in range(1000):
+            emission.emission(next(epochs))
+    return op
+
+@benchmark
+def total_supply_at_range(fixtures):
+    "total_supply_at() for 1000 epochs spread over the first 100 years."
+    epochs = itertools.cycle(range(1, 5256000, 5256))
+    def op():
+        for x in range(1000):
+            emission.total_supply_at(next(epochs))
+    return op
+
+@benchmark
+def epoch_payouts(fixtures):
+    "Payouts for 20000 nodes, skipped without numpy."
+    try:
+        import numpy
+    except ImportError:
+        return None
+    rand = numpy.random.RandomState(1)
+    percentiles = rand.uniform(0, 100, 20000)
+    online = rand.uniform(0, 1, 20000) > 0.1
+    return lambda: emission.epoch_payouts(52560, percentiles, online)
+
+def run_one(op, min_time, rounds=3):
+    """
+    Runs `op` for `min_time` seconds split over `rounds`, and reports the best
+    round so one noisy round doesn't show up as a regression.
+    """
+    op() # warm up
+    best = 0
+    for x in range(rounds):
+        count, start = 0, time.perf_counter()
+        while True:
+            op()
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= float(min_time) / rounds and count >= 3:
+                break
+        best = max(best, count / elapsed)
+
+    tracemalloc.start()
+    op()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'ops_per_sec': best, 'peak_bytes': peak}
+
+def run(fixtures, min_time=1.0, only=None):
+    results = {}
+    for func in BENCHMARKS:
+        if only and func.__name__ not in only:
+            continue
+        op = func(fixtures)
+        if op is None:
+            continue
+        results[func.__name__] = run_one(op, min_time)
+    return results
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Returns a list of (name, message) for every benchmark that regressed
+    more than `threshold` (a fraction) against the baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['ops_per_sec'] < base['ops_per_sec'] * (1 - threshold):
+            regressions.append((name, "%.1f ops/sec, baseline %.1f" % (
+                result['ops_per_sec'], base['ops_per_sec']
+            )))
+        if result['peak_bytes'] > base['peak_bytes'] * (1 + threshold) + 1024:
+            regressions.append((name, "%d bytes peak, baseline %d" % (
+                result['peak_bytes'], base['peak_bytes']
+            )))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save', action='store_true', help="Save results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed slowdown, 0.2 = 20%%")
+    parser.add_argument('--min-time', type=float, default=1.0, help="Seconds to run each benchmark")
+    parser.add_argument('--transactions', type=int, default=2000)
+    parser.add_argument('--fixtures', default=os.path.join(HERE, 'fixtures.json'))
+    parser.add_argument('only', nargs='*', help="Only run these benchmarks")
+    args = parser.parse_args(argv)
+
+    fixtures = make_fixtures(args.transactions, path=args.fixtures)
+    results = run(fixtures, args.min_time, args.only)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print("benchmark".ljust(28) + "ops/sec".rjust(14) + "baseline".rjust(14) + "peak mem".rjust(14))
+    for name, result in sorted(results.items()):
+        base = baseline.get(name, {}).get('ops_per_sec')
+        print(
+            name.ljust(28) + ("%.1f" % result['ops_per_sec']).rjust(14) +
+            ("%.1f" % base if base else "-").rjust(14) +
+            ("%dKB" % (result['peak_bytes'] // 1024)).rjust(14)
+        )
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, message in regressions:
+        print("REGRESSION %s: %s" % (name, message))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -30,5 +30,8 @@ setup(
         'requests',
         'arrow',
         'bitcoin==1.1.42',
-    ] + extra_install
+    ] + extra_install,
+    extras_require={
+        'payouts': ['numpy'],
+    }
 )
@@ -0,0 +1,95 @@
+"""
+Address checks. The same payout and exchange addresses show up in a large
+share of transactions, so pubkey -> address derivations are memoized in a
+bounded cache shared by the whole library. Address validity is only a regex
+in `bitcoin`, which is as cheap as a cache lookup, so it is not cached.
+"""
+from collections import OrderedDict
+
+BASE58_CHARS = frozenset(
+    "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+)
+
+class BoundedCache(object):
+    """
+    Least recently used cache around a function of one argument.
+    """
+    def __init__(self, func, maxsize=10000):
+        self.func = func
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, key):
+        try:
+            value = self.data.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = self.func(key)
+            self.misses += 1
+            if len(self.data) >= self.maxsize:
+                self.data.popitem(last=False)
+        self.data[key] = value
+        return value
+
+    def clear(self):
+        self.data.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0
+        }
+
+def _pubtoaddr(pubkey):
+    from bitcoin import pubtoaddr
+    return pubtoaddr(pubkey)
+
+_pubkey_cache = BoundedCache(_pubtoaddr)
+_address_stats = {'checked': 0, 'prefiltered': 0}
+
+def _looks_like_address(address):
+    """
+    Cheap check done before the full address check. Only P2PKH ("1")
+    addresses are allowed as outputs.
+    """
+    try:
+        return (
+            26 <= len(address) <= 35 and address.startswith("1") and
+            BASE58_CHARS.issuperset(address)
+        )
+    except (TypeError, AttributeError):
+        return False
+
+def is_valid_address(address):
+    """
+    Returns True if the passed in address can be used as a transaction output.
+    """
+    from bitcoin import is_address
+    if not _looks_like_address(address):
+        _address_stats['prefiltered'] += 1
+        return False
+    _address_stats['checked'] += 1
+    return is_address(address)
+
+def pubkey_to_address(pubkey):
+    """
+    Memoized version of `bitcoin.pubtoaddr`.
+    """
+    return _pubkey_cache(pubkey)
+
+def cache_stats():
+    return {
+        'address': dict(_address_stats),
+        'pubkey': _pubkey_cache.stats(),
+    }
+
+def clear_caches():
+    _pubkey_cache.clear()
+    _address_stats['checked'] = _address_stats['prefiltered'] = 0
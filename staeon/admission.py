@@ -0,0 +1,189 @@
+"""
+Admission control for incoming transactions. Signature verification is the
+expensive part of `validate_transaction`, so under load transactions are
+rate limited per peer, queued by fee, and dropped once they can no longer be
+validated within the propagation window.
+"""
+import bisect
+import datetime
+import math
+import time
+
+from .network import PROPAGATION_WINDOW_SECONDS
+
+class TokenBucket(object):
+    """
+    Allows `rate` items per second on average, with bursts up to `burst`.
+    """
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last = clock()
+
+    def consume(self, n=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def is_full(self):
+        "A full bucket behaves the same as a new one."
+        return self.tokens + (self.clock() - self.last) * self.rate >= self.burst
+
+def fee_rate(tx):
+    """
+    Fee paid per input, computed from the claimed amounts without checking any
+    signatures. Each input is one signature to verify, so this is the fee
+    paid per unit of validation work.
+    """
+    in_total = sum(float(amount) for address, amount, sig in tx['inputs'])
+    out_total = sum(float(amount) for address, amount in tx['outputs'])
+    return (in_total - out_total) / max(len(tx['inputs']), 1)
+
+class ValidationQueue(object):
+    """
+    Bounded queue of transactions waiting to be validated, highest fee rate
+    first. When full, the lowest fee transaction is evicted to make room for
+    a higher paying one. Transactions that can't be validated before their
+    propagation window closes are dropped.
+    `validation_seconds` is roughly how long validating one transaction takes.
+    Rate limits are kept for roughly `max_peers` peers, idle peers are
+    forgotten when there are more.
+    """
+    def __init__(self, maxsize=10000, peer_rate=50, peer_burst=200,
+                 validation_seconds=0.05, clock=time.time, max_peers=10000):
+        self.maxsize = maxsize
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.validation_seconds = validation_seconds
+        self.clock = clock
+        self.buckets = {}
+        self.max_peers = max_peers
+        self.prune_at = max_peers
+        self.items = [] # sorted list of (fee_rate, -seq, deadline, tx)
+        self.seq = 0
+        self.stats = {
+            'admitted': 0, 'rate_limited': 0, 'malformed': 0, 'expired': 0,
+            'queue_full': 0, 'evicted': 0, 'validated': 0, 'invalid': 0,
+        }
+
+    def __len__(self):
+        return len(self.items)
+
+    def _deadline(self, tx):
+        import dateutil.parser
+        ts = dateutil.parser.parse(tx['timestamp'])
+        delt = datetime.timedelta(seconds=PROPAGATION_WINDOW_SECONDS)
+        return time.mktime((ts + delt).timetuple()) + ts.microsecond / 1e6
+
+    def _too_late(self, deadline):
+        return self.clock() + self.validation_seconds > deadline
+
+    def offer(self, tx, peer=None):
+        """
+        Try to add a transaction received from `peer` to the queue. Returns
+        True if it was queued.
+        """
+        return self.admit(tx, peer) is None
+
+    def admit(self, tx, peer=None):
+        """
+        Same as `offer`, but returns None if the transaction was queued, or
+        the name of the counter it was shed under if not.
+        """
+        bucket = self.buckets.get(peer)
+        if not bucket:
+            if len(self.buckets) >= self.prune_at:
+                self._prune_buckets()
+            bucket = self.buckets[peer] = TokenBucket(
+                self.peer_rate, self.peer_burst, self.clock
+            )
+        if not bucket.consume():
+            return self._shed('rate_limited')
+
+        try:
+            rate = fee_rate(tx)
+            deadline = self._deadline(tx)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            return self._shed('malformed')
+        if math.isnan(rate) or math.isinf(rate) or rate < 0:
+            # NaN would break the sorted order and inf could never be evicted
+            return self._shed('malformed')
+
+        if self._too_late(deadline):
+            return self._shed('expired')
+
+        if len(self.items) >= self.maxsize:
+            if rate <= self.items[0][0]:
+                return self._shed('queue_full')
+            self.items.pop(0)
+            self.stats['evicted'] += 1
+
+        self.seq += 1
+        bisect.insort(self.items, (rate, -self.seq, deadline, tx))
+        self.stats['admitted'] += 1
+        return None
+
+    def _prune_buckets(self):
+        """
+        Forget peers whose buckets have refilled. If most peers are still
+        active, wait until there are twice as many before trying again.
+        """
+        for peer, bucket in list(self.buckets.items()):
+            if bucket.is_full():
+                del self.buckets[peer]
+        self.prune_at = max(self.max_peers, 2 * len(self.buckets))
+
+    def _shed(self, reason):
+        self.stats[reason] += 1
+        return reason
+
+    def pop(self):
+        """
+        Returns the highest fee transaction that can still make the
+        propagation window, or None if there isn't one.
+        """
+        while self.items:
+            rate, seq, deadline, tx = self.items.pop()
+            if self._too_late(deadline):
+                self.stats['expired'] += 1
+                continue
+            return tx
+        return None
+
+    def drain(self, limit=None, validator=None, **kwargs):
+        """
+        Validate up to `limit` queued transactions, best fee first. Yields
+        (tx, exception) pairs, exception is None when the transaction is
+        valid. Extra kwargs are passed to the validator, which defaults to
+        `validate_transaction`. Malformed transactions can raise anything
+        (TypeError, KeyError...), those count as invalid too.
+        """
+        if not validator:
+            from .transaction import validate_transaction as validator
+
+        count = 0
+        while limit is None or count < limit:
+            tx = self.pop()
+            if tx is None:
+                return
+            count += 1
+            try:
+                validator(tx, **kwargs)
+            except Exception as exc:
+                self.stats['invalid'] += 1
+                yield tx, exc
+            else:
+                self.stats['validated'] += 1
+                yield tx, None
+
+    def shed(self):
+        "Total number of transactions dropped without being validated."
+        return sum(self.stats[x] for x in (
+            'rate_limited', 'malformed', 'expired', 'queue_full', 'evicted'
+        ))
@@ -3,11 +3,13 @@ from __future__ import print_function
 import sys
 import datetime
 import hashlib
-from concurrent import futures
 import json
-import requests
+from collections import OrderedDict
 
-from bitcoin import ecdsa_verify, ecdsa_recover, ecdsa_sign, pubtoaddr, privtoaddr
+# `bitcoin`, `requests` and `concurrent.futures` are slow to import, so they
+# are imported within the functions that need them. This keeps things like
+# `get_epoch_number` cheap to import.
+from .addresses import pubkey_to_address
 from .exceptions import *
 from .network import *
 
@@ -47,13 +49,14 @@ def validate_timestamp(ts, now=None):
     return True
 
 def validate_sig(sig, msg, address, type="transaction"):
+    from bitcoin import ecdsa_verify, ecdsa_recover
     try:
         pubkey = ecdsa_recover(msg, sig)
     except:
         raise InvalidSignature("Can't recover pubkey from %s signature" % type)
 
     valid_sig = ecdsa_verify(msg, sig, pubkey)
-    valid_address = pubtoaddr(pubkey) == address
+    valid_address = pubkey_to_address(pubkey) == address
 
     if not valid_sig or not valid_address:
         raise InvalidSignature("%s signature not valid" % type.title())
@@ -61,6 +64,7 @@ def validate_sig(sig, msg, address, type="transaction"):
     return True
 
 def make_transaction_rejection(tx, exc, my_domain, my_pk):
+    from bitcoin import ecdsa_sign
     msg = "%s%s" % (tx['txid'], my_domain)
     return {
         'domain': my_domain,
@@ -74,8 +78,141 @@ def validate_rejection_authorization(domain, txid, sig, payout_address):
         sig, "%s%s" % (txid, domain), payout_address, "rejection"
     )
 
+class RejectionTally(object):
+    """
+    Collects transaction rejections from many peers and keeps a running count
+    per txid. `peers` is a dict of domain -> payout address. Rejections are
+    verified lazily: signatures for a txid are only checked once enough
+    rejections have arrived to possibly reach quorum, and none are checked
+    after the txid has already been rejected. Call `discard` for txids that
+    are no longer needed (or `reset` at the end of an epoch).
+
+    At most `max_candidates` unverified rejections are kept per domain and
+    more are dropped unchecked, so forged rejections can't pile up. Dropped
+    real rejections can be resent once the candidates have been verified. At
+    most `max_pending` txids are kept waiting for quorum, the oldest is
+    dropped to make room.
+    """
+    def __init__(self, peers, quorum=None, lazy=True, max_candidates=4,
+                 max_pending=100000):
+        self.peers = peers
+        self.quorum = quorum or (len(peers) // 2 + 1)
+        self.lazy = lazy
+        self.max_candidates = max_candidates
+        self.max_pending = max_pending
+        self.verified = {} # txid -> {domain: rejection}
+        self.pending = OrderedDict() # txid -> {domain: {signature: rejection}}
+        self.rejected = set()
+        self.stats = {
+            'added': 0, 'duplicate': 0, 'unknown_peer': 0, 'invalid': 0,
+            'verified': 0, 'skipped': 0, 'dropped': 0
+        }
+
+    def add(self, rejection):
+        """
+        Add a rejection object made by `make_transaction_rejection`. Returns
+        True if the rejection was accepted (not a duplicate, from an unknown
+        peer or over `max_candidates`). Unverified rejections claiming the same domain are
+        kept side by side until one of them verifies, so a forged rejection
+        can't push out the real one.
+        """
+        txid, domain = rejection['txid'], rejection['domain']
+        signature = rejection['signature']
+        if domain not in self.peers:
+            self.stats['unknown_peer'] += 1
+            return False
+
+        if domain in self.verified.get(txid, ()):
+            self.stats['duplicate'] += 1
+            return False
+        if signature in self.pending.get(txid, {}).get(domain, ()):
+            self.stats['duplicate'] += 1
+            return False
+
+        if txid in self.rejected:
+            # quorum already reached, no need to check this signature.
+            self.stats['added'] += 1
+            self.stats['skipped'] += 1
+            return True
+
+        pending = self.pending.get(txid)
+        if pending is None:
+            if len(self.pending) >= self.max_pending:
+                self.pending.popitem(last=False)
+                self.stats['dropped'] += 1
+            pending = self.pending[txid] = {}
+        candidates = pending.setdefault(domain, {})
+        if len(candidates) >= self.max_candidates:
+            self.stats['dropped'] += 1
+            return False
+        candidates[signature] = rejection
+        self.stats['added'] += 1
+        if not self.lazy or self.count(txid) + len(pending) >= self.quorum:
+            self.verify(txid)
+        return True
+
+    def add_many(self, rejections):
+        return [self.add(r) for r in rejections]
+
+    def verify(self, txid=None):
+        """
+        Verify all pending rejection signatures for the given txid, or for
+        every txid if none given. Invalid rejections are dropped.
+        """
+        txids = [txid] if txid is not None else list(self.pending.keys())
+        for txid in txids:
+            pending = self.pending.pop(txid, None)
+            if not pending:
+                continue
+            for domain, candidates in pending.items():
+                self._verify_candidates(txid, domain, candidates)
+
+    def _verify_candidates(self, txid, domain, candidates):
+        verified = self.verified.get(txid, {})
+        for rejection in candidates.values():
+            if txid in self.rejected or domain in verified:
+                self.stats['skipped'] += 1
+                continue
+            try:
+                validate_rejection_authorization(
+                    domain, txid, rejection['signature'], self.peers[domain]
+                )
+            except InvalidSignature:
+                self.stats['invalid'] += 1
+                continue
+            self.stats['verified'] += 1
+            verified[domain] = rejection
+            self.verified[txid] = verified
+            if len(verified) >= self.quorum:
+                self.rejected.add(txid)
+
+    def discard(self, txid):
+        "Forget everything about this txid."
+        self.verified.pop(txid, None)
+        self.pending.pop(txid, None)
+        self.rejected.discard(txid)
+
+    def reset(self):
+        "Forget every txid, for instance when an epoch closes."
+        self.verified.clear()
+        self.pending.clear()
+        self.rejected.clear()
+
+    def is_rejected(self, txid):
+        return txid in self.rejected
+
+    def count(self, txid):
+        "Number of verified rejections for this txid."
+        return len(self.verified.get(txid, ()))
+
+    def rejections(self, txid):
+        "All verified rejections for this txid, usable as proof of rejection."
+        return list(self.verified.get(txid, {}).values())
+
 def deterministic_shuffle(items, seed, n=0, sort_key=lambda x: x):
-    sorter = lambda x: hashlib.sha256(sort_key(x) + seed + str(n)).hexdigest()
+    sorter = lambda x: hashlib.sha256(
+        (sort_key(x) + seed + str(n)).encode('utf-8')
+    ).hexdigest()
     return sorted(items, key=sorter)
 
 def make_matrix(items, seed, sort_key=lambda x: x, width=5, n=5):
@@ -91,6 +228,7 @@ def make_matrix(items, seed, sort_key=lambda x: x, width=5, n=5):
 class EpochHashPush(object):
     @classmethod
     def make(cls, epoch, from_domain, to_domain, from_pk, hashes):
+        from bitcoin import ecdsa_sign
         msg = "%s%s%s%s" % (from_domain, to_domain, "".join(hashes), epoch)
         return {
             'epoch': epoch,
@@ -125,6 +263,9 @@ class EpochHashPush(object):
             raise InvalidObject("Epoch Hash too late")
 
 def propagate_to_peers(domains, obj=None, type="tx"):
+    from concurrent import futures
+    import requests
+
     url_template = "http://%s/%s"
     post_data = {'obj': json.dumps(obj)}
     sender = lambda url: requests.post(url, post_data)
@@ -137,6 +278,64 @@ def propagate_to_peers(domains, obj=None, type="tx"):
 
     return fetches
 
+class SeenFilter(object):
+    """
+    Remembers roughly the last `size` object ids so objects that have already
+    been gossiped are not sent again. Ids are kept in two generations, when
+    the current one fills up the older one is thrown away.
+    """
+    def __init__(self, size=100000):
+        self.size = size
+        self.current = set()
+        self.previous = set()
+
+    def __contains__(self, object_id):
+        return object_id in self.current or object_id in self.previous
+
+    def add(self, object_id):
+        "Returns True if this id has not been seen before."
+        if object_id in self:
+            return False
+        if len(self.current) >= self.size // 2:
+            self.previous, self.current = self.current, set()
+        self.current.add(object_id)
+        return True
+
+def gossip_targets(domains, object_id, my_domain, fanout=GOSSIP_FANOUT):
+    """
+    Pick which `fanout` peers this node forwards an object to. The first one
+    is the next node in a ring ordered by the object id, which every sender
+    agrees on, so following those links alone reaches the whole network. The
+    others are picked differently by each sender so the object spreads fast.
+    """
+    others = [d for d in domains if d != my_domain]
+    if not others or fanout < 1:
+        return []
+    ring = deterministic_shuffle(domains, object_id)
+    if my_domain in ring:
+        successor = ring[(ring.index(my_domain) + 1) % len(ring)]
+    else:
+        successor = ring[0]
+    rest = [
+        d for d in deterministic_shuffle(others, object_id, my_domain)
+        if d != successor
+    ]
+    return [successor] + rest[:fanout - 1]
+
+def gossip_to_peers(domains, obj, object_id, my_domain, fanout=GOSSIP_FANOUT,
+                    seen=None, type="tx"):
+    """
+    Gossip version of `propagate_to_peers`. Sends to `fanout` peers instead of
+    all of them. If a `SeenFilter` is passed, objects that have already been
+    sent or received are not sent again.
+    """
+    if seen is not None and not seen.add(object_id):
+        return {}
+    targets = gossip_targets(domains, object_id, my_domain, fanout)
+    if not targets:
+        return {}
+    return propagate_to_peers(targets, obj, type)
+
 def make_epoch_seed(epoch_tx_count, ledger_count, sorted_ledger, address_from_ledger):
     """
     epoch_tx_count = number of transactions made in a given epoch
@@ -148,13 +347,13 @@ def make_epoch_seed(epoch_tx_count, ledger_count, sorted_ledger, address_from_le
     """
     index = epoch_tx_count % ledger_count
     return hashlib.sha256(
-        str(epoch_tx_count) + address_from_ledger(sorted_ledger[index])
+        (str(epoch_tx_count) + address_from_ledger(sorted_ledger[index])).encode('utf-8')
     ).hexdigest()
 
 def make_mini_hashes(seed, limit=5):
     mini_hashes = []
     for x in range(limit):
-        seed = hashlib.sha256(seed).hexdigest()
+        seed = hashlib.sha256(seed.encode('utf-8')).hexdigest()
         mini_hashes.append(seed[:8])
     return mini_hashes
 
@@ -168,6 +367,7 @@ class NodePenalization(object):
 
     @classmethod
     def make(cls, epoch, correct_hash, wrong_push, my_pk):
+        from bitcoin import ecdsa_sign
         msg = "%s%s%s" % (
             epoch, correct_hash, cls._make_reason(wrong_push)
         )
@@ -1,10 +1,10 @@
 from math import atan as arctan, sqrt, log as ln
 
 def offline_penalty(percentile):
-    return 5 + (percent ** 2) / 146
+    return 5 + (percentile ** 2) / 146.0
 
 def online_reward(percentile):
-    return 30 - (percent ** 2) / 546
+    return 30 - (percentile ** 2) / 546.0
 
 def raw_emission(epoch):
     """
@@ -50,3 +50,40 @@ def get_decimals_for_epoch(epoch=None, reward=None):
             return decimals
         decimals += 1
         target /= 10
+
+def epoch_payouts(epoch, percentiles, online):
+    """
+    Calculates the payout for every node for the passed in epoch in one pass.
+    `percentiles` (each between 0 and 100) and `online` are equal length
+    sequences, one item per node.
+    Returns two numpy arrays, rewards and penalties:
+    rewards are in coins. Online nodes split `emission(epoch)` weighted by
+    `online_reward`, each share truncated to the decimals for that epoch,
+    offline nodes get 0.
+    penalties are not coins, they are the `offline_penalty` value for each
+    offline node (0 for online nodes), on the same scale as the
+    `online_reward` weights. How a penalty is applied is up to the caller.
+    Requires numpy.
+    """
+    import numpy
+
+    percentiles = numpy.asarray(percentiles, dtype=numpy.float64)
+    online = numpy.asarray(online, dtype=bool)
+    if percentiles.shape != online.shape:
+        raise ValueError("percentiles and online must be the same length")
+    if not ((percentiles >= 0) & (percentiles <= 100)).all():
+        raise ValueError("percentiles must be between 0 and 100")
+
+    weights = numpy.where(online, online_reward(percentiles), 0.0)
+    penalties = numpy.where(online, 0.0, offline_penalty(percentiles))
+
+    total_weight = weights.sum()
+    if not total_weight:
+        return numpy.zeros_like(weights), penalties
+
+    # work in the smallest unit so truncation is exact and the sum of all
+    # rewards never exceeds the emission.
+    scale = 10 ** get_decimals_for_epoch(epoch)
+    units = round(emission(epoch) * scale)
+    rewards = numpy.floor(units * (weights / total_weight)) / scale
+    return rewards, penalties
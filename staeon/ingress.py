@@ -0,0 +1,296 @@
+"""
+Reference asyncio server for the receiving side of `propagate_to_peers` and
+`push_peer_registration`. Requires Python 3.7+.
+
+All endpoints take form encoded POST bodies, the way `requests.post` sends
+them:
+
+    /tx               obj=<json transaction>
+    /tx/batch         objs=<json list of transactions>
+    /peerlist         registration=<json peer registration>
+    /peerlist/batch   registrations=<json list of peer registrations>
+
+Accepted objects are answered with 202 and validated in the background by a
+process pool. When the validation queues are full the server answers 503
+(or 429 when a single peer is sending too fast) so senders back off.
+"""
+import asyncio
+import json
+import logging
+import os
+from concurrent import futures
+from urllib.parse import parse_qs
+
+from .admission import ValidationQueue
+from .consensus import SeenFilter
+from .peer_registration import validate_peer_registration
+from .transaction import make_txid, validate_transaction
+
+STATUS_TEXT = {
+    202: 'Accepted',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    503: 'Service Unavailable',
+}
+
+# ValidationQueue shed reasons -> http status
+SHED_STATUS = {
+    'rate_limited': 429,
+    'queue_full': 503,
+    'malformed': 400,
+    'expired': 400,
+}
+
+log = logging.getLogger(__name__)
+
+def _validate(validator, obj, kwargs):
+    """
+    Runs in a worker process. Returns the exception instead of raising it so
+    invalid objects are not logged as failed futures. Malformed objects can
+    raise anything (KeyError, TypeError...), those count as invalid too.
+    """
+    try:
+        validator(obj, **kwargs)
+    except Exception as exc:
+        return exc
+    return None
+
+class IngressServer(object):
+    """
+    `on_transaction` and `on_registration` are called with (obj, exception)
+    after each object is validated, exception is None for valid objects.
+    `tx_queue` is a `ValidationQueue`, one is made if not given. Transactions
+    that were already accepted are answered with 202 but not validated again,
+    roughly the last `seen_size` txids are remembered. A passed in `executor`
+    is not shut down by `close`.
+    """
+    def __init__(self, on_transaction=None, on_registration=None,
+                 tx_queue=None, registration_queue_size=1000, workers=None,
+                 executor=None, max_body=1024 * 1024, tx_kwargs=None,
+                 seen_size=100000):
+        self.on_transaction = on_transaction
+        self.on_registration = on_registration
+        self.tx_queue = ValidationQueue() if tx_queue is None else tx_queue
+        self.registration_queue_size = registration_queue_size
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.owns_executor = False
+        self.seen = SeenFilter(seen_size)
+        self.max_body = max_body
+        self.tx_kwargs = tx_kwargs or {}
+        self.routes = {
+            '/tx': ('obj', False, self._admit_transaction),
+            '/tx/batch': ('objs', True, self._admit_transaction),
+            '/peerlist': ('registration', False, self._admit_registration),
+            '/peerlist/batch': ('registrations', True, self._admit_registration),
+        }
+        self.stats = {'requests': 0, 'registrations_shed': 0, 'duplicates': 0}
+        self.server = None
+        self.tasks = []
+        self.connections = set()
+
+    async def start(self, host='0.0.0.0', port=80):
+        if not self.executor:
+            self.executor = futures.ProcessPoolExecutor(self.workers)
+            self.owns_executor = True
+        self.tx_ready = asyncio.Event()
+        self.registrations = asyncio.Queue(self.registration_queue_size)
+        self.tasks = [
+            asyncio.ensure_future(self._transaction_worker())
+            for x in range(self.workers)
+        ] + [asyncio.ensure_future(self._registration_worker())]
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.server:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await asyncio.sleep(0) # let handlers see the closed connections
+            await self.server.wait_closed()
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+            self.executor, self.owns_executor = None, False
+
+    def run(self, host='0.0.0.0', port=80):
+        "Serve until interrupted."
+        async def serve():
+            server = await self.start(host, port)
+            try:
+                await server.serve_forever()
+            finally:
+                await self.close()
+        asyncio.run(serve())
+
+    def _admit_transaction(self, tx, peer):
+        try:
+            txid = make_txid(tx)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            txid = None # the queue sheds it as malformed
+        if txid is not None and txid in self.seen:
+            self.stats['duplicates'] += 1
+            return None
+        reason = self.tx_queue.admit(tx, peer)
+        if reason:
+            return reason
+        if txid is not None:
+            self.seen.add(txid)
+        self.tx_ready.set()
+
+    def _admit_registration(self, reg, peer):
+        if not isinstance(reg, dict):
+            return 'malformed'
+        try:
+            self.registrations.put_nowait(reg)
+        except asyncio.QueueFull:
+            self.stats['registrations_shed'] += 1
+            return 'queue_full'
+
+    def dispatch(self, method, path, body, peer):
+        """
+        Returns (status, response object) for a request.
+        """
+        route = self.routes.get(path.split('?')[0].rstrip('/') or '/')
+        if not route:
+            return 404, {'error': 'Not found'}
+        if method != 'POST':
+            return 405, {'error': 'POST only'}
+
+        field, batch, admit = route
+        try:
+            fields = parse_qs(body.decode('utf-8'))
+            objs = json.loads(fields[field][0])
+        except (UnicodeDecodeError, KeyError, ValueError):
+            return 400, {'error': "Can't decode '%s'" % field}
+
+        if not batch:
+            reason = admit(objs, peer)
+            if reason:
+                return SHED_STATUS[reason], {'error': reason}
+            return 202, {'accepted': 1}
+
+        if not isinstance(objs, list):
+            return 400, {'error': "'%s' must be a list" % field}
+        shed = {}
+        for obj in objs:
+            reason = admit(obj, peer)
+            if reason:
+                shed[reason] = shed.get(reason, 0) + 1
+        accepted = len(objs) - sum(shed.values())
+        response = {'accepted': accepted, 'shed': shed}
+        if accepted or not shed:
+            return 202, response
+        return SHED_STATUS[max(shed, key=shed.get)], response
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        peer = peer[0] if peer else None
+        self.connections.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if not request:
+                    break
+                method, path, keep_alive, body = request
+                self.stats['requests'] += 1
+                if body is None:
+                    status, response = 413, {'error': 'Body too large'}
+                    keep_alive = False
+                else:
+                    status, response = self.dispatch(method, path, body, peer)
+                await self._respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader):
+        """
+        Returns (method, path, keep_alive, body), body is None if it is over
+        `max_body`. Returns None when the client closed the connection.
+        """
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, path, version = line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[name.strip().lower()] = value.strip().lower()
+
+        connection = headers.get('connection', '')
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            return method, path, False, None
+        body = await reader.readexactly(length) if length else b''
+        return method, path, keep_alive, body
+
+    async def _respond(self, writer, status, response, keep_alive):
+        body = json.dumps(response).encode('utf-8')
+        headers = [
+            "HTTP/1.1 %d %s" % (status, STATUS_TEXT.get(status, '')),
+            "Content-Type: application/json",
+            "Content-Length: %d" % len(body),
+            "Connection: %s" % ("keep-alive" if keep_alive else "close"),
+        ]
+        if status in (429, 503):
+            headers.append("Retry-After: 1")
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+
+    async def _check(self, validator, obj, kwargs):
+        """
+        Validate `obj` in the pool. Never raises (except when cancelled), so
+        a bad object can't stop a worker.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                self.executor, _validate, validator, obj, kwargs
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc: # e.g. the exception couldn't be pickled
+            return exc
+
+    def _callback(self, callback, obj, exc):
+        if not callback:
+            return
+        try:
+            callback(obj, exc)
+        except Exception:
+            log.exception("Error in ingress callback")
+
+    async def _transaction_worker(self):
+        while True:
+            tx = self.tx_queue.pop()
+            if tx is None:
+                self.tx_ready.clear()
+                await self.tx_ready.wait()
+                continue
+            exc = await self._check(validate_transaction, tx, self.tx_kwargs)
+            self.tx_queue.stats['invalid' if exc else 'validated'] += 1
+            self._callback(self.on_transaction, tx, exc)
+
+    async def _registration_worker(self):
+        while True:
+            reg = await self.registrations.get()
+            exc = await self._check(validate_peer_registration, reg, {})
+            self._callback(self.on_registration, reg, exc)
@@ -6,4 +6,5 @@ EPOCH_LENGTH_SECONDS = 600
 EPOCH_CLOSING_SECONDS = 10
 PROPAGATION_WINDOW_SECONDS = 10
 EPOCH_HASH_PUSH_WINDOW_SECONDS = 20
+GOSSIP_FANOUT = 8
 SEED_NODES = ['staeon.com', 'staeon.org']
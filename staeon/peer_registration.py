@@ -1,14 +1,15 @@
+import bisect
 import datetime
-import requests
+import heapq
 import json
-from bitcoin import ecdsa_verify, ecdsa_recover, ecdsa_sign, pubtoaddr, privtoaddr
 
+from .addresses import pubkey_to_address
 from .exceptions import InvalidSignature
 from .consensus import validate_timestamp
 from .network import SEED_NODES
-import dateutil.parser
 
 def make_peer_registration(pk, domain):
+    from bitcoin import ecdsa_sign, privtoaddr
     timestamp = datetime.datetime.now().isoformat()
     address = privtoaddr(pk)
     to_sign = "%s%s%s" % (domain, address, timestamp)
@@ -19,9 +20,16 @@ def make_peer_registration(pk, domain):
         'signature': ecdsa_sign(to_sign, pk)
     }
 
-def validate_peer_registration(reg, now=None):
-    ts = dateutil.parser.parse(reg['timestamp'])
-    validate_timestamp(ts, now=now)
+def validate_peer_registration(reg, now=None, check_timestamp=True):
+    """
+    Pass `check_timestamp=False` to only check the signature, for instance
+    for registrations that come from a peerlist instead of being pushed.
+    """
+    from bitcoin import ecdsa_verify, ecdsa_recover
+    import dateutil.parser
+    if check_timestamp:
+        ts = dateutil.parser.parse(reg['timestamp'])
+        validate_timestamp(ts, now=now)
 
     to_sign = "{domain}{payout_address}{timestamp}".format(**reg)
     try:
@@ -29,17 +37,29 @@ def validate_peer_registration(reg, now=None):
     except:
         raise InvalidSignature("Can't recover pubkey from signature")
 
-    valid_address = pubtoaddr(pubkey) == reg['payout_address']
+    valid_address = pubkey_to_address(pubkey) == reg['payout_address']
     valid_sig = ecdsa_verify(to_sign, reg['signature'], pubkey)
 
     if not valid_sig or not valid_address:
         raise InvalidSignature("Invalid Signature")
     return True
 
+def _parse_timestamp(timestamp):
+    """
+    Registrations are made with naive local timestamps. Timezone aware ones
+    can't be compared with those, so they are not accepted.
+    """
+    import dateutil.parser
+    ts = dateutil.parser.parse(timestamp)
+    if ts.tzinfo is not None:
+        raise ValueError("Registration timestamp can't have a timezone")
+    return ts
+
 def get_peerlist():
     """
     Tries seed nodes until a peerlist is returned
     """
+    import requests
     response = None
     for seed in SEED_NODES:
         url = "http://%s/staeon/peerlist?top" % seed
@@ -58,6 +78,7 @@ def get_peerlist():
 
 
 def push_peer_registration(reg, peers=None, verbose=True):
+    import requests
     if not peers: peers = get_peerlist()
 
     for peer in peers:
@@ -74,3 +95,208 @@ def push_peer_registration(reg, peers=None, verbose=True):
 def register_peer(domain, pk, peers=None, verbose=True):
     reg = make_peer_registration(pk, domain)
     push_peer_registration(reg, peers=peers, verbose=verbose)
+
+def _valid_changes(response):
+    """
+    Checks the shape of a peerlist response before it is applied.
+    """
+    return (
+        isinstance(response, dict) and
+        isinstance(response.get('peers'), list) and
+        isinstance(response.get('removed', []), list) and
+        isinstance(response.get('version', 0), int)
+    )
+
+class PeerRegistry(object):
+    """
+    Local copy of the peerlist, indexed by domain and by payout address.
+    Every change bumps `version`, so other nodes can ask for only what changed
+    since the last version they saw (`changes_since`) instead of the whole
+    list. Registrations are only verified when they are new or changed, and
+    expire `ttl` seconds after their timestamp.
+    """
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self.by_domain = {}
+        self.by_address = {}
+        self.version = 0
+        self.log = [] # (version, domain) for every change, oldest first
+        self.log_start = 0 # changes up to this version have been compacted away
+        self.expiry = [] # heap of (expires, domain, timestamp)
+        self.remote_versions = {}
+        self.stats = {'verified': 0, 'unchanged': 0, 'stale': 0, 'invalid': 0, 'expired': 0}
+
+    def __len__(self):
+        return len(self.by_domain)
+
+    def __contains__(self, domain):
+        return domain in self.by_domain
+
+    def get(self, domain):
+        return self.by_domain.get(domain)
+
+    def domains_for_address(self, address):
+        return sorted(self.by_address.get(address, ()))
+
+    def peers(self):
+        return list(self.by_domain.values())
+
+    def add(self, reg, verify=True):
+        """
+        Add or update a registration. Returns True if the registry changed.
+        Raises InvalidSignature if the registration is new and not valid, and
+        KeyError, TypeError or ValueError if it is malformed. Nothing is
+        changed when it raises.
+        """
+        domain = reg['domain']
+        current = self.by_domain.get(domain)
+        if current:
+            if current['timestamp'] == reg['timestamp'] and current['signature'] == reg['signature']:
+                self.stats['unchanged'] += 1
+                return False
+            ts = _parse_timestamp(reg['timestamp'])
+            if ts <= _parse_timestamp(current['timestamp']):
+                self.stats['stale'] += 1
+                return False
+        else:
+            ts = _parse_timestamp(reg['timestamp'])
+        address = reg['payout_address']
+        hash(address) # unhashable addresses raise TypeError here
+        expires = ts + datetime.timedelta(seconds=self.ttl)
+
+        if verify:
+            try:
+                validate_peer_registration(reg, check_timestamp=False)
+            except InvalidSignature:
+                self.stats['invalid'] += 1
+                raise
+            self.stats['verified'] += 1
+
+        heapq.heappush(self.expiry, (expires, domain, reg['timestamp']))
+        if current:
+            self._unindex(current)
+        self.by_domain[domain] = reg
+        self.by_address.setdefault(address, set()).add(domain)
+        self._log(domain)
+        return True
+
+    def update(self, regs, verify=True):
+        """
+        Add many registrations, skipping invalid or malformed ones. Returns
+        the number that changed the registry.
+        """
+        changed = 0
+        for reg in regs:
+            try:
+                changed += self.add(reg, verify=verify)
+            except InvalidSignature:
+                pass # already counted by add
+            except (KeyError, TypeError, ValueError, OverflowError):
+                # missing fields or an unparsable timestamp
+                self.stats['invalid'] += 1
+        return changed
+
+    def remove(self, domain):
+        reg = self.by_domain.pop(domain, None)
+        if reg:
+            self._unindex(reg)
+            self._log(domain)
+        return reg
+
+    def _unindex(self, reg):
+        domains = self.by_address.get(reg['payout_address'])
+        if domains:
+            domains.discard(reg['domain'])
+            if not domains:
+                del self.by_address[reg['payout_address']]
+
+    def _log(self, domain):
+        self.version += 1
+        self.log.append((self.version, domain))
+        if len(self.log) > 2 * len(self.by_domain) + 100:
+            # drop the oldest half, nodes behind that get the full list.
+            half = len(self.log) // 2
+            self.log_start = self.log[half - 1][0]
+            self.log = self.log[half:]
+
+    def expire(self, now=None):
+        """
+        Remove registrations older than `ttl`. Returns the expired domains.
+        """
+        if not now: now = datetime.datetime.now()
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, domain, timestamp = heapq.heappop(self.expiry)
+            current = self.by_domain.get(domain)
+            if current and current['timestamp'] == timestamp:
+                self.remove(domain)
+                self.stats['expired'] += 1
+                expired.append(domain)
+        return expired
+
+    def changes_since(self, version):
+        """
+        What a node serves for `/staeon/peerlist?since=<version>`. Contains the
+        registrations added or changed after `version` and the domains that
+        were removed. `full` is True when the whole peerlist is returned.
+        """
+        if version < self.log_start or version > self.version:
+            return {
+                'version': self.version, 'full': True,
+                'peers': self.peers(), 'removed': []
+            }
+        peers, removed, done = [], [], set()
+        for v, domain in self.log[bisect.bisect_left(self.log, (version + 1,)):]:
+            if domain in done:
+                continue
+            done.add(domain)
+            if domain in self.by_domain:
+                peers.append(self.by_domain[domain])
+            else:
+                removed.append(domain)
+        return {
+            'version': self.version, 'full': False,
+            'peers': peers, 'removed': removed
+        }
+
+    def apply_changes(self, changes, verify=True):
+        """
+        Apply the output of another node's `changes_since`. A response without
+        a 'full' key (a plain peerlist) is treated as a full list.
+        """
+        peers = changes['peers']
+        removed = changes.get('removed', [])
+        if changes.get('full', True):
+            keep = set(
+                peer.get('domain') for peer in peers if isinstance(peer, dict)
+            )
+            removed = [d for d in list(self.by_domain) if d not in keep]
+        for domain in removed:
+            try:
+                self.remove(domain)
+            except TypeError:
+                pass # unhashable, can't be one of our domains
+        return self.update(peers, verify=verify)
+
+    def sync(self, seeds=None, timeout=10):
+        """
+        Fetch changes from the first seed node that answers within `timeout`
+        seconds. Only what changed since the last sync with that seed is
+        downloaded.
+        """
+        import requests
+        for seed in seeds or SEED_NODES:
+            since = self.remote_versions.get(seed, 0)
+            url = "http://%s/staeon/peerlist?since=%d" % (seed, since)
+            try:
+                response = requests.get(url, timeout=timeout).json()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            if not _valid_changes(response):
+                continue
+            changed = self.apply_changes(response)
+            if 'version' in response:
+                self.remote_versions[seed] = response['version']
+            return changed
+
+        raise Exception("Can't get peerlist")
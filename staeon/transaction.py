@@ -2,11 +2,7 @@ import datetime
 import random
 import hashlib
 
-import dateutil.parser
-from bitcoin import (
-    ecdsa_verify, ecdsa_recover, ecdsa_sign, pubtoaddr, privtoaddr, is_address
-)
-
+from .addresses import BoundedCache, is_valid_address, pubkey_to_address
 from .consensus import validate_timestamp
 from .exceptions import *
 from .network import PROPAGATION_WINDOW_SECONDS
@@ -31,7 +27,7 @@ def _process_outputs(outputs, timestamp):
 
         outs.append("%s,%s" % (address, amount))
 
-        if not is_address(address) or not address.startswith("1"):
+        if not is_valid_address(address):
             raise InvalidAddress("Invalid address: %s" % address)
 
     if type(timestamp) == datetime.datetime:
@@ -40,6 +36,14 @@ def _process_outputs(outputs, timestamp):
     return total_out, ";".join(outs + [timestamp])
 
 def make_transaction(inputs, outputs):
+    from bitcoin import ecdsa_sign
+    return _build_transaction(inputs, outputs, ecdsa_sign)
+
+def _build_transaction(inputs, outputs, sign, keys=None):
+    """
+    `keys` is an optional dict of privkey -> (pubkey, address). When given,
+    each input's address is checked against it.
+    """
     timestamp = datetime.datetime.now().isoformat()
     out_total, out_msg = _process_outputs(outputs, timestamp)
 
@@ -54,9 +58,11 @@ def make_transaction(inputs, outputs):
 
         if amount <= 0:
             raise InvalidAmounts("Input can't be zero or negative")
+        if keys and keys[privkey][1] != address:
+            raise InvalidAddress("Private key does not match input address: %s" % address)
         amount = _cut_to_8(amount)
         msg = "%s%s%s" % (address, amount, out_msg)
-        sig = ecdsa_sign(msg, privkey)
+        sig = sign(msg, privkey)
         in_total += amount
         tx['inputs'].append([address, amount, sig])
 
@@ -69,12 +75,64 @@ def make_transaction(inputs, outputs):
     tx['outputs'] = outputs
     return tx
 
+def _derive_key_info(privkey):
+    from bitcoin import privtopub
+    pubkey = privtopub(privkey)
+    return pubkey, pubkey_to_address(pubkey)
+
+# privkey -> (pubkey, address). Deriving these is an elliptic curve
+# multiplication, so they are cached across calls to `make_transactions`.
+_key_cache = BoundedCache(_derive_key_info)
+
+def _make_bulk_transaction(spec):
+    inputs, outputs, keys = spec
+    from bitcoin import ecdsa_raw_sign, electrum_sig_hash, encode_sig, ecdsa_verify
+
+    def sign(msg, privkey):
+        """
+        Same as `bitcoin.ecdsa_sign`, but uses the already derived public key
+        for the sanity check instead of deriving it again.
+        """
+        v, r, s = ecdsa_raw_sign(electrum_sig_hash(msg), privkey)
+        sig = encode_sig(v, r, s)
+        assert ecdsa_verify(msg, sig, keys[privkey][0]), "Bad Sig!\t %s" % sig
+        return sig
+
+    return _build_transaction(inputs, outputs, sign, keys=keys)
+
+def make_transactions(specs, workers=None, chunksize=8, executor=None):
+    """
+    Make many transactions at once. `specs` is a list of (inputs, outputs)
+    pairs, in the same format `make_transaction` takes. Signing is spread
+    across a pool of `workers` processes (defaults to the number of CPUs),
+    or across `executor` if one is passed, so a long running service can
+    reuse its pool. Pass `workers=1` to sign in this process. Returns the
+    transactions in the same order as `specs`.
+    """
+    jobs = []
+    for inputs, outputs in specs:
+        keys = dict(
+            (in_[2], _key_cache(in_[2])) for in_ in inputs if len(in_) == 3
+        )
+        jobs.append((inputs, outputs, keys))
+
+    if executor:
+        return list(executor.map(_make_bulk_transaction, jobs, chunksize=chunksize))
+    if workers == 1 or len(jobs) <= 1:
+        return [_make_bulk_transaction(job) for job in jobs]
+
+    from concurrent import futures
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_make_bulk_transaction, jobs, chunksize=chunksize))
+
 def validate_transaction(tx, ledger=None, min_fee=0.01, now=None):
     """
     Validates that the passed in transaction object is valid in terms of
     cryptography. UTXO validation does not happen here.
     `ledger` is a callable that returns the address's balance and last spend timestamp.
     """
+    from bitcoin import ecdsa_verify, ecdsa_recover
+    import dateutil.parser
     ts = dateutil.parser.parse(tx['timestamp'])
     out_total, out_msg = _process_outputs(tx['outputs'], ts)
     validate_timestamp(ts, now=now)
@@ -102,7 +160,7 @@ def validate_transaction(tx, ledger=None, min_fee=0.01, now=None):
                 raise InvalidAmounts("Not enough balance in %s" % address)
 
         valid_sig = ecdsa_verify(message, sig, pubkey)
-        valid_address = pubtoaddr(pubkey) == address
+        valid_address = pubkey_to_address(pubkey) == address
         if not valid_sig or not valid_address:
             raise InvalidSignature("Signature %s not valid" % i)
 
@@ -125,4 +183,4 @@ def make_txid(tx):
         address, amount, sig = input
         msg += "%s%s" % (address, amount)
 
-    return hashlib.sha256(msg).hexdigest()
+    return hashlib.sha256(msg.encode('utf-8')).hexdigest()
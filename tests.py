@@ -1,11 +1,34 @@
 import datetime
+import sys
 import unittest
 import dateutil.parser
 
-from staeon.transaction import make_txid, make_transaction, validate_transaction
+from staeon.transaction import (
+    make_txid, make_transaction, validate_transaction, make_transactions, _key_cache
+)
 from staeon.exceptions import *
-from staeon.peer_registration import validate_peer_registration, make_peer_registration
-from staeon.consensus import make_epoch_seed
+from staeon.peer_registration import (
+    validate_peer_registration, make_peer_registration, PeerRegistry,
+    _valid_changes
+)
+from staeon.consensus import (
+    make_epoch_seed, make_transaction_rejection, RejectionTally,
+    gossip_targets, SeenFilter
+)
+from staeon.addresses import (
+    BoundedCache, clear_caches, is_valid_address, pubkey_to_address, cache_stats
+)
+from staeon.admission import ValidationQueue
+from staeon.emission import (
+    epoch_payouts, emission, online_reward, offline_penalty
+)
+from staeon.network import PROPAGATION_WINDOW_SECONDS
+
+try:
+    import numpy
+    numpy_available = True
+except ImportError:
+    numpy_available = False
 
 i = [ # test inputs
     ['18pvhMkv1MZbZZEncKucAmVDLXZsD9Dhk6', 3.2, 'KwuVvv359oft9TfzyYLAQBgpPyCFpcTSrV9ZgJF9jKdT8jd7XLH2'],
@@ -277,5 +300,452 @@ class TestPenalization(unittest.TestCase):
 
         self.assertEquals(NodePenalization(obj, my_add, add).validate(), True)
 
+class TestRejectionTally(unittest.TestCase):
+    peers = {
+        'a.com': ['18pvhMkv1MZbZZEncKucAmVDLXZsD9Dhk6', 'KwuVvv359oft9TfzyYLAQBgpPyCFpcTSrV9ZgJF9jKdT8jd7XLH2'],
+        'b.com': ['14ZiHtrmT6Mi4RT2Liz51WKZMeyq2n5tgG', 'KxWoW9Pj45UzUH1d5p3wPe7zxbdJqU7HHkDQF1YQS1AiQg9qeZ9H'],
+        'c.com': ['18P7Tap5iJFRzz1XdEQVwV9jn8URBs6dgo', 'KwZBRN9vpPbVDBGXUehKzbLaNKykorffcvoXrHCrTKg7yWXPXr6j'],
+        'd.com': ['18YHH9D3gxu14arUNipzod5fJzUQTAFJSx', 'L1QhH1zVZoxBvXVgK2dP1wRrLeXDnHW6a5sjH9hnD9QTr9JhuKjE'],
+    }
+    tx = {'txid': 'abc123'}
+
+    def make_tally(self, **kwargs):
+        return RejectionTally(
+            dict((d, a) for d, (a, pk) in self.peers.items()), **kwargs
+        )
+
+    def reject(self, domain):
+        pk = self.peers[domain][1]
+        return make_transaction_rejection(self.tx, InvalidFee("x"), domain, pk)
+
+    def test_quorum(self):
+        tally = self.make_tally()
+        self.assertEqual(tally.quorum, 3)
+        tally.add(self.reject('a.com'))
+        tally.add(self.reject('b.com'))
+        self.assertFalse(tally.is_rejected('abc123'))
+        self.assertEqual(tally.stats['verified'], 0) # nothing verified yet
+        tally.add(self.reject('c.com'))
+        self.assertTrue(tally.is_rejected('abc123'))
+        self.assertEqual(tally.count('abc123'), 3)
+        tally.add(self.reject('d.com'))
+        self.assertEqual(tally.stats['skipped'], 1)
+
+    def test_duplicates_and_bad_sigs(self):
+        tally = self.make_tally(lazy=False)
+        self.assertTrue(tally.add(self.reject('a.com')))
+        self.assertFalse(tally.add(self.reject('a.com')))
+        self.assertFalse(tally.add(dict(self.reject('a.com'), domain='x.com')))
+        bad = dict(self.reject('b.com'), domain='c.com')
+        tally.add(bad)
+        self.assertEqual(tally.stats['invalid'], 1)
+        self.assertEqual(tally.count('abc123'), 1)
+        tally.add(self.reject('c.com')) # dropped invalid ones can be resent
+        self.assertEqual(tally.count('abc123'), 2)
+        self.assertFalse(tally.is_rejected('abc123'))
+
+    def test_forged_rejection_first(self):
+        tally = self.make_tally(quorum=2)
+        forged = dict(self.reject('b.com'), domain='a.com')
+        self.assertTrue(tally.add(forged))
+        self.assertTrue(tally.add(self.reject('a.com'))) # real vote is kept
+        self.assertEqual(tally.stats['duplicate'], 0)
+        tally.add(self.reject('c.com'))
+        self.assertTrue(tally.is_rejected('abc123'))
+        self.assertEqual(tally.stats['invalid'], 1)
+
+    def test_discard(self):
+        tally = self.make_tally()
+        tally.add(self.reject('a.com'))
+        tally.add(self.reject('a.com'))
+        tally.discard('abc123')
+        self.assertEqual((tally.pending, tally.verified), ({}, {}))
+        tally.add(dict(self.reject('b.com'), domain='c.com'))
+        tally.verify()
+        self.assertEqual((tally.pending, tally.verified), ({}, {}))
+
+    def test_forged_flood(self):
+        tally = self.make_tally()
+        forged = self.reject('b.com')
+        for x in range(5000):
+            tally.add(dict(forged, domain='a.com', signature="%s%d" % (forged['signature'], x)))
+        self.assertEqual(len(tally.pending['abc123']['a.com']), 4)
+        self.assertEqual(tally.stats['dropped'], 4996)
+        self.assertEqual(tally.stats['verified'] + tally.stats['invalid'], 0)
+        self.assertFalse(tally.add(self.reject('a.com')))
+        tally.verify() # forged ones are cleared, the real one can be resent
+        self.assertTrue(tally.add(self.reject('a.com')))
+        tally.verify()
+        self.assertEqual(tally.count('abc123'), 1)
+
+    def test_max_pending(self):
+        tally = self.make_tally(max_pending=2)
+        for txid in ('t1', 't2', 't3'):
+            tally.add(dict(self.reject('a.com'), txid=txid))
+        self.assertEqual(list(tally.pending.keys()), ['t2', 't3'])
+        self.assertEqual(tally.stats['dropped'], 1)
+
+class BulkTransactionTest(unittest.TestCase):
+    def specs(self):
+        return [
+            [[list(x) for x in i], [list(x) for x in o]] for _ in range(4)
+        ]
+
+    def test_in_process(self):
+        for tx in make_transactions(self.specs(), workers=1):
+            self.assertEqual(validate_transaction(tx, ledger), True)
+
+    def test_process_pool(self):
+        txs = make_transactions(self.specs(), workers=2, chunksize=1)
+        self.assertEqual(len(txs), 4)
+        for tx in txs:
+            self.assertEqual(validate_transaction(tx, ledger), True)
+
+    def test_executor_and_key_cache(self):
+        from concurrent import futures
+        _key_cache.clear()
+        with futures.ProcessPoolExecutor(2) as executor:
+            make_transactions(self.specs(), executor=executor)
+            txs = make_transactions(self.specs(), executor=executor)
+        for tx in txs:
+            self.assertEqual(validate_transaction(tx, ledger), True)
+        self.assertEqual(_key_cache.misses, 2) # one per key, over both calls
+
+    def test_wrong_key(self):
+        bad_i = [[i[0][0], 3.2, i[1][2]]]
+        with self.assertRaises(InvalidAddress):
+            make_transactions([[bad_i, o]], workers=1)
+
+class AddressCacheTest(unittest.TestCase):
+    def setUp(self):
+        clear_caches()
+
+    def test_valid_address(self):
+        self.assertTrue(is_valid_address('16ViwyAVeKtz4vbTXWRSYgadT5w3Rj3yuq'))
+        self.assertTrue(is_valid_address('16ViwyAVeKtz4vbTXWRSYgadT5w3Rj3yuq'))
+        self.assertFalse(is_valid_address('3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy'))
+        self.assertFalse(is_valid_address('1O0lI'))
+        self.assertFalse(is_valid_address(None))
+        stats = cache_stats()['address']
+        self.assertEqual(stats['checked'], 2)
+        self.assertEqual(stats['prefiltered'], 3)
+
+    def test_pubkey_to_address(self):
+        from bitcoin import privtopub
+        pub = privtopub(i[0][2])
+        self.assertEqual(pubkey_to_address(pub), i[0][0])
+        self.assertEqual(pubkey_to_address(pub), i[0][0])
+        self.assertEqual(cache_stats()['pubkey']['hit_rate'], 0.5)
+
+    def test_bounded(self):
+        cache = BoundedCache(lambda x: x * 2, maxsize=2)
+        cache(1); cache(2); cache(1); cache(3)
+        self.assertEqual(list(cache.data.keys()), [1, 3])
+
+class OnlineRewardTest(unittest.TestCase):
+    def test(self):
+        self.assertEqual(online_reward(0), 30)
+        self.assertEqual(offline_penalty(0), 5)
+        self.assertAlmostEqual(online_reward(50), 30 - 2500 / 546.0)
+
+@unittest.skipUnless(numpy_available, "numpy not installed")
+class EpochPayoutsTest(unittest.TestCase):
+    def test_batch(self):
+        percentiles = [0, 25, 50, 75, 100]
+        online = [True, True, False, True, False]
+        rewards, penalties = epoch_payouts(1000, percentiles, online)
+
+        weights = [online_reward(p) if o else 0 for p, o in zip(percentiles, online)]
+        for reward, weight in zip(rewards, weights):
+            expected = emission(1000) * weight / sum(weights)
+            self.assertTrue(0 <= expected - reward < 1e-8)
+            self.assertEqual(reward, float("%.8f" % reward))
+        self.assertTrue(rewards.sum() <= emission(1000))
+        self.assertEqual(penalties[2], offline_penalty(50))
+        self.assertEqual(penalties[0], 0)
+
+    def test_all_offline(self):
+        rewards, penalties = epoch_payouts(1, [10, 20], [False, False])
+        self.assertEqual(list(rewards), [0, 0])
+
+    def test_bad_percentiles(self):
+        for bad in ([50, 130], [-1, 50], [float('nan'), 50]):
+            with self.assertRaises(ValueError):
+                epoch_payouts(1, bad, [True, True])
+
+class AdmissionTest(unittest.TestCase):
+    def make_tx(self, fee, timestamp='2019-03-04T20:43:19.500000'):
+        return {
+            'inputs': [['18pvhMkv1MZbZZEncKucAmVDLXZsD9Dhk6', 1 + fee, 'sig']],
+            'outputs': [['16ViwyAVeKtz4vbTXWRSYgadT5w3Rj3yuq', 1]],
+            'timestamp': timestamp
+        }
+
+    def make_queue(self, **kwargs):
+        import time
+        self.now = time.mktime(datetime.datetime(2019, 3, 4, 20, 43, 20).timetuple())
+        return ValidationQueue(clock=lambda: self.now, **kwargs)
+
+    def test_fee_order_and_eviction(self):
+        queue = self.make_queue(maxsize=2)
+        self.assertTrue(queue.offer(self.make_tx(0.1)))
+        self.assertTrue(queue.offer(self.make_tx(0.5)))
+        self.assertTrue(queue.offer(self.make_tx(0.3)))
+        self.assertFalse(queue.offer(self.make_tx(0.05)))
+        self.assertEqual(queue.stats['evicted'], 1)
+        self.assertEqual(queue.stats['queue_full'], 1)
+        self.assertEqual(queue.pop()['inputs'][0][1], 1.5)
+        self.assertEqual(queue.pop()['inputs'][0][1], 1.3)
+        self.assertEqual(queue.pop(), None)
+
+    def test_rate_limit(self):
+        queue = self.make_queue(peer_rate=1, peer_burst=2)
+        results = [queue.offer(self.make_tx(0.1), peer='a.com') for x in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertTrue(queue.offer(self.make_tx(0.1), peer='b.com'))
+        self.now += 1
+        self.assertTrue(queue.offer(self.make_tx(0.1), peer='a.com'))
+
+    def test_deadline(self):
+        queue = self.make_queue()
+        self.assertFalse(queue.offer(self.make_tx(0.1, '2019-03-04T20:43:05')))
+        self.assertFalse(queue.offer({'inputs': []}))
+        self.assertTrue(queue.offer(self.make_tx(0.1)))
+        self.now += 10
+        self.assertEqual(queue.pop(), None)
+        self.assertEqual(queue.stats['expired'], 2)
+        self.assertEqual(queue.shed(), 3)
+
+    def test_non_finite_fees(self):
+        queue = self.make_queue(maxsize=2)
+        queue.offer(self.make_tx(0.1))
+        for amount in [float('nan'), float('inf'), 0.5]:
+            tx = self.make_tx(0)
+            tx['inputs'][0][1] = amount
+            self.assertFalse(queue.offer(tx))
+        self.assertEqual(queue.stats['malformed'], 3)
+        self.assertEqual(queue.stats['evicted'], 0)
+        self.assertEqual(len(queue), 1)
+
+    def test_drain(self):
+        queue = self.make_queue()
+        queue.offer(self.make_tx(0.1))
+        results = list(queue.drain(now=datetime.datetime(2019, 3, 4, 20, 43, 20)))
+        self.assertEqual(len(results), 1)
+        self.assertTrue(isinstance(results[0][1], InvalidSignature))
+        self.assertEqual(queue.stats['invalid'], 1)
+
+    def test_drain_malformed(self):
+        queue = self.make_queue()
+        bad = self.make_tx(0.2)
+        bad['inputs'][0][1] = "1.2"
+        queue.offer(bad)
+        queue.offer(self.make_tx(0.1))
+        results = list(queue.drain(now=datetime.datetime(2019, 3, 4, 20, 43, 20)))
+        self.assertEqual(len(results), 2)
+        self.assertTrue(isinstance(results[0][1], TypeError))
+        self.assertEqual(queue.stats['invalid'], 2)
+
+    def test_idle_peers_forgotten(self):
+        queue = self.make_queue(peer_rate=1, peer_burst=2, max_peers=2)
+        queue.offer(self.make_tx(0.1), peer='a.com')
+        queue.offer(self.make_tx(0.1), peer='b.com')
+        queue.offer(self.make_tx(0.1), peer='c.com')
+        self.assertEqual(len(queue.buckets), 3) # all still active
+        self.now += 2
+        for peer in ('c.com', 'd.com', 'e.com'):
+            queue.offer(self.make_tx(0.1), peer=peer)
+        self.assertEqual(sorted(queue.buckets), ['c.com', 'd.com', 'e.com'])
+
+class GossipSimulationTest(unittest.TestCase):
+    def simulate(self, nodes, fanout, txid):
+        """
+        Every node forwards the object to its gossip targets the first time
+        it sees it. Each hop takes between 50 and 500ms.
+        Returns (coverage, latest arrival in seconds, most messages sent by one node).
+        """
+        import hashlib
+        import heapq
+
+        def latency(a, b):
+            h = hashlib.sha256((a + b).encode()).hexdigest()
+            return 0.05 + int(h[:4], 16) / 65535.0 * 0.45
+
+        seen = dict((n, SeenFilter()) for n in nodes)
+        sent = dict((n, 0) for n in nodes)
+        arrivals = {}
+        events = [(0, nodes[0])]
+        while events:
+            t, node = heapq.heappop(events)
+            if not seen[node].add(txid):
+                continue
+            arrivals[node] = t
+            for target in gossip_targets(nodes, txid, node, fanout):
+                sent[node] += 1
+                heapq.heappush(events, (t + latency(node, target), target))
+
+        return len(arrivals) / float(len(nodes)), max(arrivals.values()), max(sent.values())
+
+    def test(self):
+        nodes = ["node%d.com" % x for x in range(500)]
+        for txid in ['abc', 'def', '123']:
+            coverage, latest, most_sent = self.simulate(nodes, 8, txid)
+            self.assertEqual(coverage, 1.0)
+            self.assertTrue(latest < PROPAGATION_WINDOW_SECONDS / 2.0)
+            self.assertEqual(most_sent, 8)
+        # the ring links alone reach every node
+        self.assertEqual(self.simulate(nodes[:100], 1, 'abc')[0], 1.0)
+
+    def test_seen_filter(self):
+        seen = SeenFilter(size=4)
+        self.assertTrue(seen.add('a'))
+        self.assertFalse(seen.add('a'))
+        for x in 'bcdef':
+            seen.add(x)
+        self.assertFalse('a' in seen)
+        self.assertTrue('f' in seen)
+
+class PeerRegistryTest(unittest.TestCase):
+    pks = [
+        'KwuVvv359oft9TfzyYLAQBgpPyCFpcTSrV9ZgJF9jKdT8jd7XLH2',
+        'KxWoW9Pj45UzUH1d5p3wPe7zxbdJqU7HHkDQF1YQS1AiQg9qeZ9H',
+        'KwZBRN9vpPbVDBGXUehKzbLaNKykorffcvoXrHCrTKg7yWXPXr6j',
+    ]
+
+    def test_delta_sync(self):
+        server, client = PeerRegistry(), PeerRegistry()
+        regs = [make_peer_registration(pk, "node%d.com" % n) for n, pk in enumerate(self.pks)]
+        server.update(regs)
+        self.assertEqual(server.domains_for_address(regs[0]['payout_address']), ['node0.com'])
+
+        client.apply_changes(server.changes_since(0))
+        self.assertEqual(len(client), 3)
+        version = server.version
+
+        server.add(make_peer_registration(self.pks[0], 'node0.com'))
+        server.remove('node2.com')
+        changes = server.changes_since(version)
+        self.assertEqual([p['domain'] for p in changes['peers']], ['node0.com'])
+        self.assertEqual(changes['removed'], ['node2.com'])
+
+        client.apply_changes(changes)
+        self.assertEqual(sorted(client.by_domain), ['node0.com', 'node1.com'])
+        self.assertEqual(client.stats['verified'], 4)
+
+        client.apply_changes(server.changes_since(0))
+        self.assertEqual(client.stats['verified'], 4) # nothing new to verify
+        self.assertEqual(client.stats['unchanged'], 2)
+
+    def test_malformed_entries(self):
+        registry = PeerRegistry()
+        registry.update([make_peer_registration(self.pks[1], 'old.com')])
+        good = make_peer_registration(self.pks[0], 'a.com')
+        no_timestamp = dict(good, domain='b.com')
+        del no_timestamp['timestamp']
+        changes = {'full': True, 'peers': [
+            {'timestamp': good['timestamp']}, no_timestamp,
+            dict(good, domain='c.com', timestamp='not a date'), 'junk', good
+        ]}
+        self.assertEqual(registry.apply_changes(changes), 1)
+        self.assertEqual(sorted(registry.by_domain), ['a.com'])
+        self.assertEqual(registry.stats['invalid'], 4)
+
+    def test_timezone_aware(self):
+        registry = PeerRegistry()
+        registry.add(make_peer_registration(self.pks[0], 'a.com'))
+        version = registry.version
+        aware = make_peer_registration(self.pks[1], 'b.com')
+        aware['timestamp'] += '+00:00'
+        self.assertEqual(registry.update([aware], verify=False), 0)
+        self.assertEqual(registry.stats['invalid'], 1)
+        self.assertEqual((sorted(registry.by_domain), registry.version), (['a.com'], version))
+        self.assertEqual(len(registry.expiry), 1)
+
+    def test_bad_sync_responses(self):
+        for response in ([], None, {'version': 3}, {'peers': None}, {'peers': [], 'removed': None}):
+            self.assertFalse(_valid_changes(response))
+        self.assertTrue(_valid_changes({'version': 3, 'full': True, 'peers': []}))
+
+    def test_invalid_and_expiry(self):
+        registry = PeerRegistry(ttl=60)
+        reg = make_peer_registration(self.pks[0], 'a.com')
+        with self.assertRaises(InvalidSignature):
+            registry.add(dict(reg, domain='b.com'))
+        self.assertTrue(registry.add(reg))
+
+        ts = dateutil.parser.parse(reg['timestamp'])
+        self.assertEqual(registry.expire(ts + datetime.timedelta(seconds=59)), [])
+        self.assertEqual(registry.expire(ts + datetime.timedelta(seconds=60)), ['a.com'])
+        self.assertEqual(registry.by_address, {})
+
+@unittest.skipIf(sys.version_info < (3, 4), "benchmarks need tracemalloc")
+class MicroBenchmarkTest(unittest.TestCase):
+    # make sure every benchmark in benchmarks/micro.py still runs.
+    def test(self):
+        import os, sys
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+        import micro
+        fixtures = micro.make_fixtures(transactions=3, peers=20, ledger=100)
+        results = micro.run(fixtures, min_time=0.001)
+        self.assertTrue('validate_transaction' in results)
+        baseline = dict((name, {'ops_per_sec': r['ops_per_sec'] * 10, 'peak_bytes': r['peak_bytes']}) for name, r in results.items())
+        self.assertEqual(len(micro.compare(results, baseline)), len(results))
+        self.assertEqual(micro.compare(results, results), [])
+
+    def test_fixture_cache(self):
+        import os, sys, tempfile
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks'))
+        import micro
+        path = os.path.join(tempfile.mkdtemp(), 'fixtures.json')
+        micro.make_fixtures(transactions=2, peers=5, ledger=10, path=path)
+        fixtures = micro.make_fixtures(transactions=2, peers=7, ledger=10, path=path)
+        self.assertEqual(len(fixtures['peers']), 7)
+        os.remove(path)
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs python 3.7+")
+class ImportTimeTest(unittest.TestCase):
+    # make sure slow dependencies are not loaded until they are needed.
+    heavy = ['bitcoin', 'requests', 'dateutil', 'concurrent.futures']
+    budget_us = 60000 # total microseconds allowed for importing staeon modules
+
+    def import_times(self, *args):
+        import subprocess, sys
+        proc = subprocess.Popen(
+            [sys.executable, '-X', 'importtime'] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        out, err = proc.communicate()
+        times, top_level = {}, {}
+        for line in err.decode().splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            self_us, cumulative, name = line[12:].split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+                if not name.startswith("  "):
+                    top_level[name.strip()] = int(cumulative)
+        return times, top_level
+
+    def test_library(self):
+        times, top_level = self.import_times('-c', (
+            "import staeon.consensus, staeon.transaction, "
+            "staeon.peer_registration, staeon.emission"
+        ))
+        for module in self.heavy:
+            self.assertNotIn(module, times, msg="%s imported at startup" % module)
+        total = sum(t for name, t in top_level.items() if name.startswith("staeon"))
+        self.assertLess(total, self.budget_us, msg="Import time regressed")
+
+    def test_cli(self):
+        import os
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'staeon')
+        times, top_level = self.import_times(script, '--help')
+        self.assertNotIn('staeon.peer_registration', times)
+
+if sys.version_info >= (3, 7):
+    # asyncio tests live in their own module so this file still compiles
+    # under python 2.7.
+    from tests_ingress import IngressTest
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,117 @@
+"""
+Tests for staeon.ingress. Python 3.7+ only, imported by tests.py when
+running on a new enough python.
+"""
+import asyncio
+import json
+import unittest
+from concurrent import futures
+from urllib.parse import urlencode
+
+from staeon.admission import ValidationQueue
+from staeon.ingress import IngressServer
+from staeon.peer_registration import make_peer_registration
+from staeon.transaction import make_transaction
+
+i = [
+    ['18pvhMkv1MZbZZEncKucAmVDLXZsD9Dhk6', 3.2, 'KwuVvv359oft9TfzyYLAQBgpPyCFpcTSrV9ZgJF9jKdT8jd7XLH2'],
+    ['14ZiHtrmT6Mi4RT2Liz51WKZMeyq2n5tgG', 0.5, 'KxWoW9Pj45UzUH1d5p3wPe7zxbdJqU7HHkDQF1YQS1AiQg9qeZ9H']
+]
+o = [
+    ['16ViwyAVeKtz4vbTXWRSYgadT5w3Rj3yuq', 2.2],
+    ['18pPTxvTc9rJZfD2tM1bNYHFhAcZjgqEdQ', 1.4]
+]
+
+async def post(port, path, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = urlencode(data).encode()
+    writer.write((
+        "POST %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+        "Content-Length: %d\r\n\r\n" % (path, len(body))
+    ).encode() + body)
+    response = await reader.read()
+    writer.close()
+    return int(response.split()[1])
+
+async def wait_for(condition, timeout=5):
+    for x in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+
+class IngressTest(unittest.TestCase):
+    def test(self):
+        results = []
+        executor = futures.ThreadPoolExecutor(1)
+        async def run():
+            server = IngressServer(
+                on_transaction=lambda tx, exc: results.append(exc),
+                tx_queue=ValidationQueue(maxsize=1, peer_rate=0.001, peer_burst=2),
+                executor=executor, workers=1
+            )
+            sock = (await server.start('127.0.0.1', 0)).sockets[0]
+            port = sock.getsockname()[1]
+            txs = [json.dumps(make_transaction(i, list(o))) for x in range(5)]
+            statuses = [
+                await post(port, '/tx', {'obj': txs[0]}),
+                await post(port, '/tx', {'obj': '{bad json'}),
+                await post(port, '/nothing', {'obj': txs[0]}),
+                await post(port, '/tx', {'obj': txs[0]}), # duplicate
+                await post(port, '/tx', {'obj': txs[1]}),
+                await post(port, '/tx', {'obj': txs[2]}), # over peer_burst
+            ]
+            await wait_for(lambda: len(results) == 2)
+            # fill the queue without giving the worker a chance to run
+            server.tx_queue.peer_burst = 100
+            first = server.dispatch('POST', '/tx', ('obj=' + txs[3]).encode(), 'x')
+            second = server.dispatch('POST', '/tx', ('obj=' + txs[4]).encode(), 'x')
+            await server.close()
+            self.assertEqual(server.stats['duplicates'], 1)
+            return statuses + [first[0], second[0]]
+
+        statuses = asyncio.run(run())
+        self.assertEqual(statuses, [202, 400, 404, 202, 202, 429, 202, 503])
+        self.assertEqual(results, [None, None])
+        # the executor was passed in, so close() leaves it running
+        self.assertEqual(executor.submit(len, 'abc').result(), 3)
+        executor.shutdown()
+
+    def test_malformed_then_valid(self):
+        # objects that blow up inside validation, and callbacks that raise,
+        # must not stop the workers.
+        tx_results, reg_results = [], []
+        def on_transaction(tx, exc):
+            tx_results.append(exc)
+            raise Exception("callback error")
+
+        async def run():
+            server = IngressServer(
+                on_transaction=on_transaction,
+                on_registration=lambda reg, exc: reg_results.append(exc),
+                executor=futures.ThreadPoolExecutor(1), workers=1
+            )
+            port = (await server.start('127.0.0.1', 0)).sockets[0].getsockname()[1]
+
+            bad_tx = make_transaction(i, list(o))
+            bad_tx['inputs'][0][1] = "3.2"
+            await post(port, '/tx', {'obj': json.dumps(bad_tx)})
+            await wait_for(lambda: len(tx_results) == 1)
+            await post(port, '/tx', {'obj': json.dumps(make_transaction(i, list(o)))})
+
+            reg = make_peer_registration(i[0][2], 'example.com')
+            bad_reg = dict(reg)
+            del bad_reg['timestamp']
+            await post(port, '/peerlist', {'registration': json.dumps(bad_reg)})
+            await post(port, '/peerlist', {'registration': json.dumps(reg)})
+
+            await wait_for(lambda: len(tx_results) == 2 and len(reg_results) == 2)
+            await server.close()
+
+        asyncio.run(run())
+        self.assertTrue(isinstance(tx_results[0], TypeError))
+        self.assertEqual(tx_results[1], None)
+        self.assertTrue(isinstance(reg_results[0], KeyError))
+        self.assertEqual(reg_results[1], None)
+
+if __name__ == '__main__':
+    unittest.main()